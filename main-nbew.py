@@ -1,76 +1,80 @@
 import os
 import csv
+import functools
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone, datetime, timedelta, time
-import json
+from time import gmtime
 
-from elasticsearch import Elasticsearch
-from tqdm import tqdm
+import orjson
+import pandas as pd
+from elasticsearch import ApiError, Elasticsearch, NotFoundError, OrjsonSerializer, TransportError
 
 
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+log_formatter.converter = gmtime
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(log_formatter)
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 logger = logging.getLogger(__name__)
 logging.getLogger("elastic_transport.transport").setLevel(logging.WARNING)
 
 ELASTICSEARCH_HOST = os.getenv('ELASTICSEARCH_HOST')
 ELASTICSEARCH_APIKEY = os.getenv('ELASTICSEARCH_APIKEY')
 OUTPUT_FILE = 'datastream_shard_stats.csv'
-
-
-def log_message(message, level="info"):
-    if level == "info":
-        tqdm.write(f"{datetime.now(timezone.utc)} - INFO - {message}")
-    elif level == "error":
-        tqdm.write(f"{datetime.now(timezone.utc)} - ERROR - {message}")
+MAX_WORKERS = 12
+CONNECTIONS_PER_NODE = 32
+# Keeps comma-joined index names well under Elasticsearch's 4kb request line limit
+MAX_INDEX_BATCH_CHARS = 3000
+CSV_BUFFER_SIZE = 1 << 20
+# Checked in order; "nonprod" must come before "prod"
+ENVIRONMENT_KEYWORDS = (
+    ("nonprod", "nonprod"),
+    ("prod", "prod"),
+    ("dev", "dev"),
+    ("default", "default"),
+    ("operations", "operations"),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_es_client():
+    """Return the shared Elasticsearch client, creating it on first use."""
+    return Elasticsearch(
+        ELASTICSEARCH_HOST,
+        api_key=ELASTICSEARCH_APIKEY,
+        http_compress=True,
+        connections_per_node=CONNECTIONS_PER_NODE,
+        sniff_on_start=False,
+        retry_on_timeout=True,
+        serializer=OrjsonSerializer()
+    )
 
 
 def get_previous_day():
     """Return the start and end datetime objects from the previous day."""
     today = datetime.now(timezone.utc)
-    start_of_day = datetime.combine(today - timedelta(days=), time.min)
+    start_of_day = datetime.combine(today - timedelta(days=1), time.min)
     end_of_day = datetime.combine(today, time.min)
-    log_message(f"start: {start_of_day.isoformat()}, end: {
-                end_of_day.isoformat()}")
+    logger.info("start: %s, end: %s", start_of_day.isoformat(), end_of_day.isoformat())
     return start_of_day, end_of_day
 
 
+@functools.lru_cache(maxsize=65536)
 def classify_environment(datastream_name):
     """Classify the environment based on keywords in the datastream name."""
     datastream_name_lower = datastream_name.lower()
-    if "nonprod" in datastream_name_lower:
-        return "nonprod"
-    if "prod" in datastream_name_lower:
-        return "prod"
-    if "dev" in datastream_name_lower:
-        return "dev"
-    if "default" in datastream_name_lower:
-        return "default"
-    if "operations" in datastream_name_lower:
-        return "operations"
-    else:
-        return "other"
-
-
-def get_all_indices(es_client):
-    """Fetch all indices from the cluster."""
-    try:
-        indices = es_client.cat.indices(format='json')
-        return [index['index'] for index in indices]
-    except Exception as e:
-        log_message(f"Error fetching all indices: {e}", level="error")
-        return []
+    for keyword, environment in ENVIRONMENT_KEYWORDS:
+        if keyword in datastream_name_lower:
+            return environment
+    return "other"
 
 
 def get_indices_with_data(es_client, start_date, end_date):
-    """Fetch indices that have data within the given date range."""
-    indices_with_data = []
-    problematic_indices = []
-    all_indices = get_all_indices(es_client)
-
-    log_message(f"Found {len(all_indices)} indices to check.")
-
+    """Fetch indices that have data within the given date range, or None if the search was incomplete."""
     query = {
+        "size": 0,
         "query": {
             "range": {
                 "@timestamp": {
@@ -79,42 +83,91 @@ def get_indices_with_data(es_client, start_date, end_date):
                 }
             }
         },
-        "size": 1
+        "aggs": {
+            "idx": {
+                "terms": {
+                    "field": "_index",
+                    "size": 65536
+                }
+            }
+        }
     }
 
-    for index in tqdm(all_indices, desc="Checking indices"):
-        try:
+    try:
+        response = es_client.search(
+            index="*", body=query, expand_wildcards="open,hidden",
+            allow_no_indices=True, ignore_unavailable=True, request_cache=True)
+    except Exception as e:
+        logger.error("Error searching indices for data: %s", e)
+        return None
+
+    # Failed or timed out shards silently drop their indices from the
+    # aggregation, so treat them as a failed probe
+    shards = response['_shards']
+    if shards.get('failed') or response.get('timed_out'):
+        logger.error("Search for indices with data was incomplete (%s of %s shards failed, timed out: %s): %s",
+                     shards.get('failed', 0), shards.get('total'), response.get('timed_out'),
+                     shards.get('failures', []))
+        return None
+
+    indices_with_data = [bucket['key']
+                         for bucket in response['aggregations']['idx']['buckets']]
+    logger.info("Found %d indices with data.", len(indices_with_data))
 
-            response = es_client.search(
-                index=index, body=query, allow_no_indices=True)
-            # logger.debug(f"Looking inside {index}")
-            if response['hits']['total']['value'] > 0:
-                # log_message(f"Appended: {index}")
-                indices_with_data.append(index)
-        except Exception as e:
-            log_message(f"Error searching index '{index}': {e}", level="error")
-            problematic_indices.append(index)
+    return indices_with_data
 
-    if problematic_indices:
-        log_message(f"\nSkipped problematic indices due to errors: {
-                    problematic_indices}")
 
-    return indices_with_data
+def batch_indices(indices, max_chars=MAX_INDEX_BATCH_CHARS):
+    """Split index names into batches whose comma-joined length fits in a request URL."""
+    batch = []
+    batch_length = 0
+    for index in indices:
+        if batch and batch_length + len(index) > max_chars:
+            yield batch
+            batch = []
+            batch_length = 0
+        batch.append(index)
+        batch_length += len(index) + 1
 
+    if batch:
+        yield batch
 
-def get_shard_stats(es_client):
-    try:
-        stats = es_client.indices.stats(level='shards')
-        return stats['indices']
-    except Exception as e:
-        log_message(f"Error fetching shard stats {e}", level="error")
-        return
+
+def get_shard_stats(es_client, indices):
+    """Yield (index, stats) pairs, fetching shard stats one batch of indices at a time."""
+    for batch in batch_indices(indices):
+        while batch:
+            try:
+                stats = es_client.indices.stats(
+                    index=batch, level='shards', metric='store',
+                    filter_path="indices.*.shards.*.store.size_in_bytes,indices.*.shards.*.routing.primary")
+                break
+            except NotFoundError as e:
+                # An index deleted (e.g. by ILM) since it was found has no size
+                # to report, so drop it and retry the rest of the batch
+                error = e.body.get('error', {}) if isinstance(e.body, dict) else {}
+                missing = error.get('index') or error.get('resource.id')
+                if missing not in batch:
+                    logger.error("Error fetching shard stats %s", e)
+                    raise
+                logger.warning("Index %s no longer exists, skipping it", missing)
+                batch = [index for index in batch if index != missing]
+            except (ApiError, TransportError) as e:
+                # A missing batch would under-report every datastream in it, so
+                # fail the run rather than write an incomplete report
+                logger.error("Error fetching shard stats %s", e)
+                raise
+        else:
+            continue
+
+        yield from stats.get('indices', {}).items()
 
 
 def map_indices_to_datastreams(es_client):
     """Fetch data streams and map indices to their parent data streams."""
     try:
-        datastreams = es_client.indices.get_data_stream()
+        datastreams = es_client.indices.get_data_stream(
+            filter_path="data_streams.name,data_streams.indices.index_name")
         index_to_datastream = {}
 
         for ds in datastreams['data_streams']:
@@ -124,23 +177,56 @@ def map_indices_to_datastreams(es_client):
         return index_to_datastream
 
     except Exception as e:
-        log_message(f"Error fetching data streams: {e}", level="error")
+        logger.error("Error fetching data streams: %s", e)
         return
 
-def fetch_datastream_config(es_client, datastream_name, valid_indices):
+def fetch_index_settings(es_client):
+    """Fetch the shard and replica settings of every index in one request."""
+    try:
+        settings = es_client.indices.get_settings(
+            index="*", expand_wildcards="open,hidden",
+            filter_path="*.settings.index.number_of_shards,*.settings.index.number_of_replicas")
+        return {index: data.get('settings', {}).get('index', {})
+                for index, data in settings.items()}
+    except Exception as e:
+        logger.error("Error fetching index settings: %s", e)
+        return {}
+
+
+def fetch_ilm_policies(es_client):
+    """Fetch all ILM policies, mapping each policy name to its compacted phases."""
+    try:
+        policies = es_client.ilm.get_lifecycle()
+    except Exception as e:
+        logger.error("Error fetching ILM policies: %s", e)
+        return {}
+
+    ilm_policies = {}
+    for policy_name, details in policies.items():
+        phases = details.get('policy', {}).get('phases', {})
+        ilm_policies[policy_name] = {
+            phase: orjson.dumps(phase_details).decode()
+            for phase, phase_details in phases.items()
+        }
+    return ilm_policies
+
+
+def fetch_datastream_config(es_client, datastream_name, valid_indices, index_settings, ilm_policies):
     """Fetch datastream configurations, including primary/replica settings and ILM policy"""
 
     try: 
-        log_message(f"Fetching config for datastream: {datastream_name}")
-        datastream_details = es_client.indices.get_data_stream(name=datastream_name)
-        log_message(f"Datastream details: {datastream_details}")
+        logger.debug("Fetching config for datastream: %s", datastream_name)
+        datastream_details = es_client.indices.get_data_stream(
+            name=datastream_name,
+            filter_path="data_streams.template,data_streams.ilm_policy,data_streams.indices.index_name")
+        logger.debug("Datastream details: %s", datastream_details)
         datastreams = datastream_details.get('data_streams', [])
 
         template_name = datastreams[0].get('template', 'Unknown')
-        log_message(f"Template name: {template_name}")
+        logger.debug("Template name: %s", template_name)
 
         ilm_policy_name = datastreams[0].get('ilm_policy', 'None')
-        log_message(f"ILM policy name: {ilm_policy_name}")
+        logger.debug("ILM policy name: %s", ilm_policy_name)
 
         backing_indices = [index['index_name'] for index in datastreams[0].get('indices', [])]
 
@@ -154,23 +240,17 @@ def fetch_datastream_config(es_client, datastream_name, valid_indices):
                 "ilm_phases": {}
             }
 
-        index_settings = es_client.indices.get_settings(index=first_valid_index)
-        index_config = index_settings.get(first_valid_index, {}).get('settings', {}).get('index', {})
+        index_config = index_settings.get(first_valid_index, {})
 
         number_of_primaries = index_config.get('number_of_shards', 'Unknown')
         number_of_replicas = index_config.get('number_of_replicas', 'Unknown')
 
         ilm_phases = {}
         if ilm_policy_name != 'None':
-            try:
-                ilm_details = es_client.ilm.get_lifecycle(name=ilm_policy_name)
-                policy = ilm_details[ilm_policy_name]['policy']
-                phases = policy.get('phases', {})
-                for phase, phase_details in phases.items():
-                    compact_json = json.dumps(phase_details, separators=(',', ':'))
-                    ilm_phases[phase] = compact_json
-            except Exception as e:
-                log_message(f"Error fetching ILM policy '{ilm_policy_name}: {e}")
+            ilm_phases = ilm_policies.get(ilm_policy_name)
+            if ilm_phases is None:
+                logger.info("ILM policy '%s' not found", ilm_policy_name)
+                ilm_phases = {}
 
         return {
             "primaries": number_of_primaries,
@@ -179,7 +259,7 @@ def fetch_datastream_config(es_client, datastream_name, valid_indices):
             "ilm_phases": ilm_phases
         }
     except Exception as e:
-        log_message(f"Error fetching datastream config for {datastream_name}: {e}", level="error")
+        logger.error("Error fetching datastream config for %s: %s", datastream_name, e)
         return {
             "primaries": "Unknown",
             "replicas": "Unknown",
@@ -189,51 +269,62 @@ def fetch_datastream_config(es_client, datastream_name, valid_indices):
 
 def aggregate_shard_sizes(shard_stats, index_to_datastream, valid_indices):
     """Aggregate shard sizes by data stream."""
-    datastream_sizes = {}
+    rows = []
 
-    for index, data in shard_stats.items():
+    for index, data in shard_stats:
         if index not in valid_indices:
             continue
 
-        datastream = index_to_datastream.get(index, "Unknown")
-        shards = data.get('shards', {})
-
         primary_size = 0
         replica_size = 0
-
-        for shard_list in shards.values():
+        for shard_list in data.get('shards', {}).values():
             for shard in shard_list:
-                size = shard['store']['size_in_bytes']
                 if shard['routing']['primary']:
-                    primary_size += size
+                    primary_size += shard['store']['size_in_bytes']
                 else:
-                    replica_size += size
-
-        if datastream not in datastream_sizes:
-            log_message(f"Initiating datastream entry for: {datastream}")
-            datastream_sizes[datastream] = {
-                "indices": [],
-                "total_size": 0,
-                "primary_size": 0,
-                "replica_size": 0
-            }
+                    replica_size += shard['store']['size_in_bytes']
 
-        if "indices" not in datastream_sizes[datastream] or "total_size" not in datastream_sizes[datastream]:
-            log_message(f"Unexpected structure for datastream_sizes[{
-                        datastream}]: {datastream_sizes[datastream]}")
-            continue
+        rows.append((index_to_datastream.get(index, "Unknown"), index, primary_size, replica_size))
+
+    if not rows:
+        return {}
 
-        datastream_sizes[datastream]['indices'].append(index)
-        datastream_sizes[datastream]['total_size'] += primary_size + replica_size
-        datastream_sizes[datastream]['primary_size'] += primary_size
-        datastream_sizes[datastream]['replica_size'] += replica_size
+    df = pd.DataFrame(rows, columns=['datastream', 'index', 'primary_size', 'replica_size'])
+    datastream_sizes = df.groupby('datastream', sort=False).agg(
+        indices=('index', list),
+        primary_size=('primary_size', 'sum'),
+        replica_size=('replica_size', 'sum'))
+    datastream_sizes['total_size'] = datastream_sizes['primary_size'] + datastream_sizes['replica_size']
 
-    return datastream_sizes
+    return datastream_sizes.to_dict('index')
 
 
 def write_to_csv(datastream_sizes, output_file, datastream_configs):
     """Write the aggregated data stream sizes to a CSV file."""
-    with open(output_file, mode='w', newline='') as file:
+
+    def rows():
+        for datastream, data in datastream_sizes.items():
+            config = datastream_configs.get(datastream, {})
+            ilm_phases = config.get("ilm_phases", {})
+
+            yield (
+                datastream,
+                ", ".join(data['indices']),
+                data['total_size'],
+                data['primary_size'],
+                data['replica_size'],
+                config.get("primaries", "Unknown"),
+                config.get("replicas", "Unknown"),
+                config.get("ilm_policy", "None"),
+                ilm_phases.get("hot", ""),
+                ilm_phases.get("warm", ""),
+                ilm_phases.get("cold", ""),
+                ilm_phases.get("frozen", ""),
+                ilm_phases.get("delete", ""),
+                classify_environment(datastream)
+            )
+
+    with open(output_file, mode='w', newline='', buffering=CSV_BUFFER_SIZE) as file:
         writer = csv.writer(file)
         writer.writerow([
             "Datastream", 
@@ -251,89 +342,58 @@ def write_to_csv(datastream_sizes, output_file, datastream_configs):
             "Delete",
             "Environment"
         ])
-        for datastream, data in datastream_sizes.items():
-            indices_list = ", ".join(data['indices'])
-            total_size = data['total_size']
-            primary_size = data['primary_size']
-            replica_size = data['replica_size']
-
-            config = datastream_configs.get(datastream, {})
-            configured_primaries = config.get("primaries", "Unknown")
-            configured_replicas = config.get("replicas", "Unknown")
-            ilm_policy = config.get("ilm_policy", "None")
-            ilm_phases = config.get("ilm_phases", "None")
-
-            hot_actions = ilm_phases.get("hot", "")
-            warm_actions = ilm_phases.get("warm", "")
-            cold_actions = ilm_phases.get("cold", "")
-            frozen_actions = ilm_phases.get("frozen", "")
-            delete_actions = ilm_phases.get("delete", "")
-
-            environment = classify_environment(datastream)
-            writer.writerow([
-                datastream, 
-                indices_list,
-                total_size,
-                primary_size,
-                replica_size,
-                configured_primaries,
-                configured_replicas,
-                ilm_policy,
-                hot_actions,
-                warm_actions,
-                cold_actions,
-                frozen_actions,
-                delete_actions,
-                environment
-            ])
+        writer.writerows(rows())
 
 
 def main():
-    es_client = Elasticsearch(
-        ELASTICSEARCH_HOST,
-        api_key=ELASTICSEARCH_APIKEY
-    )
+    es_client = get_es_client()
 
     start_of_day, end_of_day = get_previous_day()
 
-    valid_indices = get_indices_with_data(es_client, start_of_day, end_of_day)
-
-    if not valid_indices:
-        log_message("No indices found with data for the previous day.")
+    indices_with_data = get_indices_with_data(es_client, start_of_day, end_of_day)
+    if indices_with_data is None:
+        logger.error("Could not determine indices with data, not writing %s", OUTPUT_FILE)
+        return 1
 
-    shard_stats = get_shard_stats(es_client)
+    # Membership is checked per index and per backing index, so keep a set for O(1) lookups
+    valid_indices = set(indices_with_data)
 
-    if not shard_stats:
-        log_message("No shard stats retrieved.", level="error")
-        return
+    if not valid_indices:
+        logger.info("No indices found with data for the previous day.")
 
-    log_message("Mapping indecies to datastreams")
+    logger.info("Mapping indecies to datastreams")
     index_to_datastream = map_indices_to_datastreams(es_client)
-    log_message("Mapping complete.")
+    logger.info("Mapping complete.")
 
     if not index_to_datastream:
-        log_message("No datastreams found", level="error")
-
-    log_message("Aggregating shard sizes")
-    datastream_sizes = aggregate_shard_sizes(
-        shard_stats, index_to_datastream, valid_indices)
-    log_message("Aggregation complete")
+        logger.error("No datastreams found")
 
-    datastream_configs = {}
-    for datastream in datastream_sizes.keys():
-        datastream_configs[datastream] = fetch_datastream_config(es_client, datastream, valid_indices)
-
-    log_message("Writing CSV file to disc")
+    logger.info("Aggregating shard sizes")
+    shard_stats = get_shard_stats(es_client, indices_with_data)
+    try:
+        datastream_sizes = aggregate_shard_sizes(
+            shard_stats, index_to_datastream, valid_indices)
+    except (ApiError, TransportError):
+        logger.error("Shard stats incomplete, not writing %s", OUTPUT_FILE, exc_info=True)
+        return 1
+    logger.info("Aggregation complete")
+
+    logger.info("Fetching datastream configs")
+    index_settings = fetch_index_settings(es_client)
+    ilm_policies = fetch_ilm_policies(es_client)
+    datastreams = list(datastream_sizes.keys())
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        configs = executor.map(
+            lambda datastream: fetch_datastream_config(
+                es_client, datastream, valid_indices, index_settings, ilm_policies),
+            datastreams)
+        datastream_configs = dict(zip(datastreams, configs))
+
+    logger.info("Writing CSV file to disc")
     write_to_csv(datastream_sizes, OUTPUT_FILE, datastream_configs)
 
-    log_message(f"Datastream shard stats written to {OUTPUT_FILE}")
-
-    # for datastream, data in datastream_sizes.items():
-    #     log_message(f"\nDatastream: {datastream}")
-    #     log_message(f" Total Size: {data['total_size']} bytes")
-    #     for index in data['indices']:
-    #         log_message(f" Index: {index}")
+    logger.info("Datastream shard stats written to %s", OUTPUT_FILE)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,36 +1,80 @@
 from datetime import datetime, timedelta
+import asyncio
+import functools
 import os
-import time
+import sys
 import csv
-import urllib3
 
-from elasticsearch import Elasticsearch, exceptions
-
-# Removes insecure warning if system doesn't have the certificate
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from elasticsearch import AsyncElasticsearch, exceptions
 
 ELASTICSEARCH_HOST = os.getenv('ELASTICSEARCH_HOST')
 ELASTICSEARCH_APIKEY = os.getenv('ELASTICSEARCH_APIKEY')
 OUTPUT_FILE = 'daily_ingest_report.csv'
-
-
-es = Elasticsearch(ELASTICSEARCH_HOST,
-                   api_key=ELASTICSEARCH_APIKEY, verify_certs=False)
-
-
-def get_all_indices():
+MSEARCH_BATCH_SIZE = 200
+CSV_BUFFER_SIZE = 1 << 20
+# Optional: indices created longer ago than this are assumed to have been
+# rolled over and are not probed. Unset means no age cutoff.
+MAX_INDEX_AGE_DAYS = os.getenv('MAX_INDEX_AGE_DAYS')
+# Upper bound on requests in flight, to avoid overwhelming Elasticsearch.
+# Every request takes one semaphore permit, so this also sizes the connection pool.
+MAX_CONCURRENT_REQUESTS = 32
+
+
+# AsyncElasticsearch uses aiohttp as its transport, install elasticsearch[async]
+@functools.lru_cache(maxsize=None)
+def get_es_client():
+    # ssl_show_warn=False removes the insecure warning if system doesn't have the certificate
+    return AsyncElasticsearch(ELASTICSEARCH_HOST,
+                              api_key=ELASTICSEARCH_APIKEY, verify_certs=False,
+                              ssl_show_warn=False,
+                              http_compress=True,
+                              connections_per_node=MAX_CONCURRENT_REQUESTS,
+                              sniff_on_start=False, retry_on_timeout=True)
+
+
+async def limited(semaphore, request):
+    # Each request holds one semaphore permit while it is in flight
+    async with semaphore:
+        return await request
+
+
+async def get_all_indices():
+    es = get_es_client()
     try:
-        indices = es.cat.indices(format="json", h='index')
-        return [index['index'] for index in indices]
+        indices = await es.cat.indices(
+            format="json", h='index,creation.date,docs.count,status')
     except exceptions.BadRequestError as e:
         print(f"Error fetching indices: {e}")
         return []
 
-
-def is_index_active_today(index):
+    # Closed and empty indices can't have data from today, so leave them out
+    # instead of probing them
+    candidates = [
+        index for index in indices
+        if index['status'] == 'open' and index['docs.count'] not in (None, '0')
+    ]
+    print(f"Skipping {len(indices) - len(candidates)} of {len(indices)} indices that are closed or empty")
+
+    if MAX_INDEX_AGE_DAYS:
+        start_of_today = datetime.combine(datetime.now().date(), datetime.min.time())
+        oldest_creation_ms = (start_of_today - timedelta(days=int(MAX_INDEX_AGE_DAYS))).timestamp() * 1000
+        too_old = [index['index'] for index in candidates
+                   if int(index['creation.date']) < oldest_creation_ms]
+        if too_old:
+            print(f"Skipping {len(too_old)} indices created more than {MAX_INDEX_AGE_DAYS} days ago: {', '.join(too_old)}")
+        candidates = [index for index in candidates
+                      if int(index['creation.date']) >= oldest_creation_ms]
+
+    return [index['index'] for index in candidates]
+
+
+async def get_active_indices_today(indices, semaphore, batch_size=MSEARCH_BATCH_SIZE):
+    es = get_es_client()
     today = datetime.now().date()
     query = {
-        "size": 1,
+        "size": 0,
+        "track_total_hits": 1,
+        "terminate_after": 1,
         "query": {
             "range": {
                 "@timestamp": {
@@ -40,11 +84,36 @@ def is_index_active_today(index):
             }
         }
     }
-    try:
-        response = es.search(index=index, body=query)
-        return response['hits']['total']['value'] > 0
-    except exceptions.BadRequestError:
-        return False
+
+    async def check_batch(start):
+        batch = indices[start:start + batch_size]
+        searches = []
+        for index in batch:
+            searches.append({"index": index})
+            searches.append(query)
+
+        async with semaphore:
+            print(f"Checking indices {start + 1}-{start + len(batch)} of {len(indices)}")
+            # A failed batch would drop up to batch_size indices from the
+            # report, so let the error fail the run (the client already
+            # retries timeouts)
+            response = await es.msearch(
+                body=searches,
+                filter_path="responses.hits.total.value,responses.error.type")
+
+        # Responses come back in the same order as the searches were sent
+        return [index for index, result in zip(batch, response['responses'])
+                if 'error' not in result and result['hits']['total']['value'] > 0]
+
+    # Let every batch finish before raising, so no request is left running
+    # against a closed client
+    batches = await asyncio.gather(
+        *[check_batch(start) for start in range(0, len(indices), batch_size)],
+        return_exceptions=True)
+    for batch in batches:
+        if isinstance(batch, BaseException):
+            raise batch
+    return [index for batch in batches for index in batch]
 
 
 def calculate_daily_ingest(size_in_bytes, first_timestamp, last_timestamp):
@@ -64,14 +133,23 @@ def calculate_daily_ingest(size_in_bytes, first_timestamp, last_timestamp):
         return 0
 
 
-def get_index_stats(index):
+async def get_index_stats(index, semaphore):
+    es = get_es_client()
     try:
-        stats = es.indices.stats(index=index, level='shards', metric='store')
-        size_in_bytes = stats['indices'][index]['primaries']['store']['size_in_bytes']
+        print(f"Gathering stats for index: {index}")
+        # Stats plus first and last document timestamps, fetched concurrently
+        stats, first_doc, last_doc = await asyncio.gather(
+            limited(semaphore, es.indices.stats(
+                index=index, metric='store',
+                filter_path="indices.*.primaries.store.size_in_bytes")),
+            limited(semaphore, es.search(
+                index=index, size=1, sort="@timestamp:asc",
+                source_includes=["@timestamp"])),
+            limited(semaphore, es.search(
+                index=index, size=1, sort="@timestamp:desc",
+                source_includes=["@timestamp"])))
 
-        # Get first and last document timestamps
-        first_doc = es.search(index=index, size=1, sort="@timestamp:asc")
-        last_doc = es.search(index=index, size=1, sort="@timestamp:desc")
+        size_in_bytes = stats['indices'][index]['primaries']['store']['size_in_bytes']
 
         first_timestamp = first_doc['hits']['hits'][0]['_source'].get(
             '@timestamp', 'N/A')
@@ -88,48 +166,45 @@ def get_index_stats(index):
             'daily_ingest_mb': str(daily_ingest_mb).replace(".", ",") # 123,21 instead of 123.21 for stupid excel
         }
 
-    except exceptions.BadRequestError as e:
-        print(f"Error fetching stats for index {index}: {e}")
+    # Skip just this index on failure (e.g. deleted by ILM mid-run, a timeout,
+    # or no documents left), so one index can't abort the whole gather
+    except (exceptions.ApiError, exceptions.TransportError, KeyError, IndexError) as e:
+        print(f"Error fetching stats for index {index}: {e!r}")
         return None
 
 
-def initialize_csv(filename=OUTPUT_FILE):
-    with open(filename, mode='w', newline='') as file:
+def write_to_csv(rows, filename=OUTPUT_FILE):
+    with open(filename, mode='w', newline='', buffering=CSV_BUFFER_SIZE) as file:
         writer = csv.DictWriter(file, delimiter=';', fieldnames=[
             'index', 'first_timestamp', 'last_timestamp', 'daily_ingest_mb'
         ])
         writer.writeheader()
+        writer.writerows(rows)
 
 
-def append_to_csv(data, filename=OUTPUT_FILE):
-    with open(filename, mode='a', newline='') as file:
-        writer = csv.DictWriter(file, delimiter=';', fieldnames=[
-            'index', 'first_timestamp', 'last_timestamp', 'daily_ingest_mb'
-        ])
-        writer.writerow(data)
+async def main():
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
+    try:
+        print("Fetching all indices...")
+        indices = await get_all_indices()
 
-def main():
-    print("Fetching all indices...")
-    indices = get_all_indices()
+        print("Checking which indices have data from today...")
+        try:
+            active_indices = await get_active_indices_today(indices, semaphore)
+        except (exceptions.ApiError, exceptions.TransportError) as e:
+            print(f"Error checking indices, not writing {OUTPUT_FILE}: {e!r}")
+            return 1
 
-    active_indices = []
-    print("Checking which indices have data from today...")
-    for index in indices:
-        print(f"Checking index: {index}")
-        if is_index_active_today(index):
-            active_indices.append(index)
+        print(f"Found {len(active_indices)} active indices.")
 
-    print(f"Found {len(active_indices)} active indices.")
+        results = await asyncio.gather(
+            *[get_index_stats(index, semaphore) for index in active_indices])
+    finally:
+        await get_es_client().close()
 
-    initialize_csv()
-    for index in active_indices:
-        print(f"Gathering stats for index: {index}")
-        stats = get_index_stats(index)
-        if stats:
-            append_to_csv(stats)
-        time.sleep(0.1)  # To avoid overwhelming Elasticsearch
+    write_to_csv(stats for stats in results if stats)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(asyncio.run(main()))
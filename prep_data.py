@@ -1,15 +1,30 @@
-import csv
+import functools
 import re
+from collections import Counter
 import pandas as pd
 import argparse
 import os
 import hashlib
 from elasticsearch import Elasticsearch, helpers
 
+VERSION_RE = re.compile(r"\d+\.\d+\.\d+")
+DATE_RE = re.compile(r"\d{4}\.\d{2}\.\d{2}")
+DIGITS_RE = re.compile(r"\d+")
+# Picks the parser branch in a single match: data stream backing indices
+# (".ds-" prefix) or dotted legacy names
+INDEX_NAME_RE = re.compile(r"(?P<data_stream>\.ds-)|(?P<legacy>[^.]*\.)")
 
+BULK_THREAD_COUNT = 8
+CONNECTIONS_PER_NODE = 32
+
+
+# Callers must not mutate the returned dict, it is shared between cache hits
+@functools.lru_cache(maxsize=65536)
 def parse_index_name(index_name):
-    
-    if "." in index_name and not index_name.startswith(".ds-"):
+    match = INDEX_NAME_RE.match(index_name)
+    kind = match.lastgroup if match else None
+
+    if kind == "legacy":
         parts = index_name.split(".")
 
         dataset = parts[0] if len(parts) > 0 else None
@@ -17,7 +32,7 @@ def parse_index_name(index_name):
         suffix = parts[-1] if len(parts) > 1 else None
 
         environment = "default"
-        if suffix and re.match(r"\d+\.\d+\.\d+", suffix):
+        if suffix and VERSION_RE.match(suffix):
             namespace = ".".join(parts[1:-2]) if len(parts) > 3 else None
             environment = parts[-2] if len(parts) > 2 else "default"
 
@@ -35,7 +50,7 @@ def parse_index_name(index_name):
             "iteration": None,
         }
 
-    if index_name.startswith(".ds-") or ".ds-" in index_name or re.search(r"\.ds-[\w\.-]", index_name):
+    if kind == "data_stream":
         print("special case")
 
         stripped_name = index_name.lstrip(".ds-")
@@ -43,8 +58,8 @@ def parse_index_name(index_name):
 
         dataset = parts[0]
         namespace = "-".join(parts[1:-2]) if len(parts) > 2 else None
-        date = parts[-2] if len(parts) > 1 and re.match(r"\d{4}\.\d{2}\.\d{2}", parts[-2]) else None
-        iteration = parts[-1] if len(parts) > 1 and re.match(r"\d+", parts[-1]) else None
+        date = parts[-2] if len(parts) > 1 and DATE_RE.match(parts[-2]) else None
+        iteration = parts[-1] if len(parts) > 1 and DIGITS_RE.match(parts[-1]) else None
 
         if namespace is None and len(parts) > 1:
             namespace = "-".join(parts[1:])
@@ -72,47 +87,6 @@ def parse_index_name(index_name):
             "iteration": iteration
         }
 
-    primary_pattern = (
-        r"\.ds-(?P<type>\w+)-(?P<dataset>\w+)(?:\.(?P<namespace>[\w\.\-]+))?-(?P<created_date>\d{4}\.\d{2}\.\d{2})-(?P<iteration>\d+)"
-    )
-
-    match = re.match(primary_pattern, index_name)
-    
-    if not match:
-        
-        secondary_pattern = (
-            r"\.ds-(?P<type>\w+)-(?P<dataset>\w+)-(?P<namespace>\w+)-(?P<created_date>\d{4}\.\d{2}\.\d{2})-(?P<iteration>\d+)"
-        )
-        match = re.match(secondary_pattern, index_name)
-
-    if match:
-        dataset = match.group("dataset")
-        namespace = match.group("namespace")
-        environment = None
-
-        if namespace:
-            if "-" in namespace:
-                namespace_split = namespace.rsplit("-", 1)
-                namespace = namespace_split[0]
-                environment = namespace_split[1]
-  
-        else:
-            environment = "default"
-
-        application = f"{dataset}"
-        if namespace:
-            application += f".{namespace}"
-
-        return {
-            "type": match.group("type"),
-            "dataset": dataset,
-            "namespace": namespace,
-            "environment": environment,
-            "application": application,
-            "created_date": match.group("created_date"),
-            "iteration": match.group("iteration")
-        }
-    
     return {
         "type": None,
         "dataset": None,
@@ -136,22 +110,49 @@ def parse_arguments():
 def generate_document_id(index_name):
     return hashlib.sha256(index_name.encode()).hexdigest()
 
-def ingest_to_elasticsearch(es_host, es_index, es_api_key, data):
-    es = Elasticsearch(
+@functools.lru_cache(maxsize=None)
+def get_es_client(es_host, es_api_key):
+    return Elasticsearch(
         es_host,
-        api_key=es_api_key
+        api_key=es_api_key,
+        http_compress=True,
+        connections_per_node=CONNECTIONS_PER_NODE,
+        sniff_on_start=False,
+        retry_on_timeout=True
     )
 
-    actions = [
-        {
+def generate_actions(es_index, df):
+    columns = list(df.columns)
+    for row in df.itertuples(index=False, name=None):
+        record = {
+            column: None if pd.isna(value) else value
+            for column, value in zip(columns, row)
+        }
+        yield {
             "_id": generate_document_id(record["index_name"]),
             "_index": es_index,
             "_source": record
         }
-        for record in data
-    ]
-    helpers.bulk(es, actions)
-    print(f"Data ingested into Elasticsearch index: {es_index}")
+
+def ingest_to_elasticsearch(es_host, es_index, es_api_key, df):
+    es = get_es_client(es_host, es_api_key)
+
+    errors = Counter()
+    for ok, info in helpers.parallel_bulk(
+        es, generate_actions(es_index, df),
+        thread_count=BULK_THREAD_COUNT, chunk_size=1000, queue_size=4, raise_on_error=False
+    ):
+        if not ok:
+            error = next(iter(info.values()), {}).get("error")
+            errors[error.get("type") if isinstance(error, dict) else str(error)] += 1
+
+    failed = sum(errors.values())
+    if failed:
+        summary = ", ".join(f"{error_type}: {count}" for error_type, count in errors.most_common())
+        print(f"Failed to ingest {failed} documents into Elasticsearch index {es_index} ({summary})")
+    else:
+        print(f"Data ingested into Elasticsearch index: {es_index}")
+    return failed
 
 
 def main():
@@ -169,41 +170,31 @@ def main():
 
     cluster_name = input_file.split('.')[0]
 
-    data = []
-    with open(input_file, "r") as file:
-        reader = csv.reader(file, delimiter=';')
-        header = next(reader)
-        index_col = header.index("index")
-
-        first_timestamp_col = header.index("first_timestamp")
-        last_timestamp_col = header.index("last_timestamp")
-        daily_ingest_mb_col = header.index("daily_ingest_mb")
-
-        for row in reader:
-            index_name = row[index_col]
-            parsed_data = parse_index_name(index_name)
-
-            daily_ingest_mb = float(row[daily_ingest_mb_col].replace(",", "."))
-            daily_ingest_bytes = int(daily_ingest_mb * 1024 * 1024)
+    raw = pd.read_csv(input_file, sep=';', dtype=str, keep_default_na=False)
 
-            record = {
-                "index_name": index_name,
-                "cluster": cluster_name,
-                "first_timestamp": row[first_timestamp_col],
-                "last_timestamp": row[last_timestamp_col],
-                "daily_ingest_bytes": daily_ingest_bytes,
-                **parsed_data
-            }
+    daily_ingest_bytes = (
+        raw["daily_ingest_mb"].str.replace(",", ".").astype(float) * 1024 * 1024
+    ).astype("int64")
 
-            data.append(record)
+    df = pd.DataFrame({
+        "index_name": raw["index"],
+        "cluster": cluster_name,
+        "first_timestamp": raw["first_timestamp"],
+        "last_timestamp": raw["last_timestamp"],
+        "daily_ingest_bytes": daily_ingest_bytes,
+    })
+    parsed = pd.DataFrame.from_records(
+        [parse_index_name(index_name) for index_name in raw["index"]], index=raw.index)
+    df = pd.concat([df, parsed], axis=1)
 
-    df = pd.DataFrame(data)
     df.to_csv(output_file, index=False)
 
     print(f"Processed data saved to {output_file}")
 
     if args.ingest:
-        ingest_to_elasticsearch(es_host, es_index, es_api_key, data)
+        failed = ingest_to_elasticsearch(es_host, es_index, es_api_key, df)
+        if failed:
+            exit(1)
 
 if __name__ == "__main__":
     main()